@@ -1,34 +1,197 @@
 #!/usr/bin/python3
 
+"""
+
+Description:
+  Python3 scripts to draw the density scatter of a retrieval against a reference
+  And report slope, intercept, R^2, RMSE and bias of the pairs
+
+Reference data:
+  aodInversion.py writes only AOT550, Latitude and Longitude
+  So the reference has to come from a file on the same grid, e.g.
+  Another product regridded to the scene, or AOT550 with a reference
+  Dataset added by the user, such as interpolated ground measurements
+  For station matchups use matchup.py, which plots its pairs itself
+
+Arguments:
+  -x, --xname=NAME (OPTIONAL)
+         Dataset holding the reference
+         Reference by default
+  -y, --yname=NAME (OPTIONAL)
+         Dataset holding the retrieval
+         AOT550 by default
+  -r, --reference=FILE (OPTIONAL)
+         Read the reference dataset from FILE instead of the retrieval file
+         Both datasets must have the same shape
+  -v, --valid=FLOAT,FLOAT (OPTIONAL)
+         Keep only retrievals strictly between the two values
+         0,6 by default, the success range of aodInversion.py
+  -l, --lim=FLOAT (OPTIONAL)
+         Upper limit of both axes
+         3 by default
+  -o, --output=FILE (OPTIONAL)
+         Save the plot to FILE instead of showing it
+  -h, --help
+         Show the manuals to this script
+
+Example:
+  ScatterPlot.py -r MODIS_regridded.hdf5 -x AOD_550 AOT550.hdf5
+    Means AOT550 in AOT550.hdf5 against AOD_550 in MODIS_regridded.hdf5
+  ScatterPlot.py -x AERONET -l 2 -o scatter.png AOT550.hdf5
+    Means AOT550 against AERONET in the same file
+    with axes from 0 to 2 and saved to scatter.png
+
+"""
+
+import sys
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.colors import LogNorm
+from getopt import getopt, GetoptError
+from h5py import File as openh5
+
+
+#Display Usage in stdout
+def usage():
+  with open(sys.argv[0]) as fo:
+    for _ in range(3): next(fo)
+    for _ in iter(int, 1):
+      l=fo.readline()
+      if l.startswith('"""'): break
+      else: print(l.rstrip())
+  sys.exit(2)
+
+
+#Yield (x, y) pairs chunk by chunk, x is the reference and y the retrieval
+#x is read from xfn if given, otherwise from fn
+#Pairs with NaN on either side are dropped, as are retrievals outside
+#the open range valid, (0, 6) like the success test of aodInversion.py
+def getdata(fn, xname='Reference', yname='AOT550', chunk=1<<20, xfn=None, valid=(0, 6)):
+  with openh5(fn) as fo, openh5(xfn or fn) as fx:
+    xds, yds=fx[xname], fo[yname]
+    if xds.shape!=yds.shape:
+      raise ValueError('%s%s and %s%s differ in shape' % (xname, xds.shape, yname, yds.shape))
+    #Read whole rows, about chunk points at a time
+    rows=max(chunk//int(np.prod(xds.shape[1:])), 1)
+    for r in range(0, xds.shape[0], rows):
+      x, y=xds[r:r+rows].ravel(), yds[r:r+rows].ravel()
+      keep=np.isfinite(x)&(y>valid[0])&(y<valid[1])
+      yield x[keep].astype(np.float64), y[keep].astype(np.float64)
 
-def getdata(fn):
-  pass
-  return x, y
 
-def scplot(x, y):
+#Centred moments merged chunk by chunk (Chan et al.) for one-pass regression
+#and a fixed-bin 2D histogram, so memory is bounded by the bin count,
+#not the point count, and data far from zero keeps its precision
+class Density(object):
+  def __init__(self, lim=250, bins=500):
+    self.lim=lim
+    self.edges=np.linspace(0, lim, bins+1)
+    self.hist=np.zeros((bins, bins), dtype=np.int64)
+    self.n=0
+    self.mx=self.my=self.md=0. #means of x, y and y-x
+    self.cxx=self.cyy=self.cxy=self.cdd=0. #sums of centred products
+
+  def add(self, x, y):
+    x=np.asarray(x, dtype=np.float64).ravel()
+    y=np.asarray(y, dtype=np.float64).ravel()
+    nb=x.size
+    if nb==0: return self
+    d=y-x
+    mx, my, md=x.mean(), y.mean(), d.mean()
+    dx, dy, dd=x-mx, y-my, d-md
+    na, n=self.n, self.n+nb
+    ex, ey, ed=mx-self.mx, my-self.my, md-self.md
+    w=na*nb/n
+    self.cxx+=np.dot(dx, dx)+ex*ex*w
+    self.cyy+=np.dot(dy, dy)+ey*ey*w
+    self.cxy+=np.dot(dx, dy)+ex*ey*w
+    self.cdd+=np.dot(dd, dd)+ed*ed*w
+    self.mx+=ex*nb/n
+    self.my+=ey*nb/n
+    self.md+=ed*nb/n
+    self.n=n
+    self.hist+=np.histogram2d(x, y, bins=(self.edges, self.edges))[0].astype(np.int64)
+    return self
+
+  #slope, intercept, R^2, RMSE and bias of y against x
+  #All nan below 2 pairs, the fit is nan if x is constant, R^2 if either is
+  def stats(self):
+    nan=float('nan')
+    n=self.n
+    if n<2: return nan, nan, nan, nan, nan
+    slope=self.cxy/self.cxx if self.cxx>0 else nan
+    intercept=self.my-slope*self.mx
+    r2=self.cxy*self.cxy/(self.cxx*self.cyy) if self.cxx>0 and self.cyy>0 else nan
+    rmse=np.sqrt(max(self.cdd/n+self.md*self.md, 0.))
+    bias=self.md
+    return slope, intercept, r2, rmse, bias
+
+
+def densityplot(d, fn=None):
+  if d.n<2:
+    print('Not enough pairs to plot: ', d.n)
+    return
+  outside=d.n-int(d.hist.sum())
+  if outside: print('n of pairs outside the axes: ', outside)
+  if outside==d.n:
+    print('No pair within 0 to %g, set a larger axis limit' % d.lim)
+    return
+  slope, intercept, r2, rmse, bias=d.stats()
+  lim=d.lim
   plt.figure(figsize=(7, 7), dpi=300)
-  plt.scatter(x,y, c='black', s=2)
-  plt.xticks(range(0, 250, 50), fontsize=8)
-  plt.yticks(range(0, 250, 50), fontsize=8)
+  hist=np.ma.masked_equal(d.hist.T, 0)
+  plt.pcolormesh(d.edges, d.edges, hist, cmap='jet', norm=LogNorm(), rasterized=True)
+  plt.colorbar(shrink=0.8).set_label('Count', fontdict={'size': 8})
+  plt.xticks(np.linspace(0, lim, 6), fontsize=8)
+  plt.yticks(np.linspace(0, lim, 6), fontsize=8)
   plt.xlabel("X Value", fontdict={'size': 8})
   plt.ylabel("Y Value", fontdict={'size': 8})
   plt.title('Title', fontdict={'size': 10})
-  coefs=np.polyfit(x, y, 1)
-  p=np.poly1d(coefs)
-  y_=p(x)
-  r2=1-(((y-y_)**2).sum()/((y-np.array(y).mean())**2).sum())
-  plt.plot(x, y_, "r-")
-  plt.plot(range(0, 450, 50), range(0, 450, 50), 'k--')
-  plt.xlim(0, 250)
-  plt.ylim(0, 250)
+  if np.isfinite(slope): plt.plot([0, lim], [intercept, slope*lim+intercept], "r-")
+  plt.plot([0, lim], [0, lim], 'k--')
+  plt.xlim(0, lim)
+  plt.ylim(0, lim)
   plt.gca().set_aspect('equal', adjustable='box')
   label="""y=%4.2fx%+4.2f
-$R^2=%6.4f$""" % (coefs[0], coefs[1], r2)
-  plt.text(160, 10, label)
-  plt.show()
+$R^2=%6.4f$
+RMSE=%6.4f
+Bias=%+6.4f
+N=%d""" % (slope, intercept, r2, rmse, bias, d.n)
+  plt.text(0.64*lim, 0.04*lim, label)
+  if fn: plt.savefig(fn)
+  else: plt.show()
+
+
+def scplot(x, y, lim=250):
+  densityplot(Density(lim).add(x, y))
+
 
 if __name__=='__main__':
-  x,y=getdata(fn)
-  scplot(x, y)
+
+  #Default parameters
+  xname, yname, xfn, lim, outfn, valid='Reference', 'AOT550', None, 3., None, (0, 6)
+
+  #Update parameters from CLI
+  try:
+    opts, args=getopt(sys.argv[1:], 'x:y:r:v:l:o:h',
+              ['xname=', 'yname=', 'reference=', 'valid=', 'lim=', 'output=', 'help'])
+    for opt, arg in opts:
+      if opt in ['-x', '--xname']: xname=arg
+      elif opt in ['-y', '--yname']: yname=arg
+      elif opt in ['-r', '--reference']: xfn=arg
+      elif opt in ['-v', '--valid']: valid=[float(_) for _ in arg.split(',')]
+      elif opt in ['-l', '--lim']: lim=float(arg)
+      elif opt in ['-o', '--output']: outfn=arg
+      elif opt in ['-h', '--help']: usage()
+      else: assert False, "unhandled option"
+  except (GetoptError, ValueError): usage()
+  if len(args)!=1 or len(valid)!=2: usage()
+
+  d=Density(lim)
+  try:
+    for x, y in getdata(args[0], xname, yname, xfn=xfn, valid=valid):
+      d.add(x, y)
+  except KeyError as e:
+    print('Dataset not found, set it with -x/-y/-r: ', e)
+    sys.exit(2)
+  densityplot(d, outfn)
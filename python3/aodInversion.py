@@ -1,16 +1,66 @@
 #!/usr/bin/python3
 
-#import getopt
+"""
+
+Description:
+  Python3 scripts to retrieve AOT550 from HJ2A PSAC data with a 6SV LUT
+  Made by lut.py, and report timings and failure reasons of the run
+
+Usage:
+  aodInversion.py [OPTIONS] [PSAC LUT OUTPUT]
+  PSAC, LUT and OUTPUT default to
+  HJ2A_PSAC_E116.9_N35.8_20201106_L10000015715.hdf5, LUT_670 and AOT550.hdf5
+
+Arguments:
+  -t, --timers (OPTIONAL)
+         Time every stage into the report
+  -r, --report=FILE (OPTIONAL)
+         JSON run report with pixel counts per failure reason
+         OUTPUT with .json suffix by default
+  -p, --profile=FILE (OPTIONAL)
+         Run under cProfile and dump the stats to FILE, readable by pstats
+  -s, --scenetime=TIME (OPTIONAL)
+         ISO scene time stored as SceneTime with the output, e.g. 2020-11-06T03:10:00
+         Used by matchup.py for its time tolerance
+         Date in the PSAC name by default
+  -h, --help
+         Show the manuals to this script
+
+Example:
+  aodInversion.py -t -s 2020-11-06T03:10:00 PSAC.hdf5 LUT_670 AOT550.hdf5
+    Means AOT550.hdf5 with scene time 03:10 UTC
+    and AOT550.json with timings of every stage
+  aodInversion.py -p prof.out PSAC.hdf5 LUT_670 AOT550.hdf5
+    Means profile the run, read it by python3 -m pstats prof.out
+
+"""
+
 from warnings import filterwarnings
 filterwarnings('ignore')
 
+import re
 import sys
+import json
+import time
+from os import path
 import numpy as np
+from getopt import getopt, GetoptError
 from array import array
 from copy import deepcopy
 from h5py import File as openh5
 
 
+#Display Usage in stdout
+def usage():
+  with open(sys.argv[0]) as fo:
+    for _ in range(3): next(fo)
+    for _ in iter(int, 1):
+      l=fo.readline()
+      if l.startswith('"""'): break
+      else: print(l.rstrip())
+  sys.exit(2)
+
+
 #Read PSAC TOA at 670 nm
 #And assume SR at 670 nm equal quarter of TOA at 2250 nm
 #And TOA at 443 nm and 1380 nm to mask cloud
@@ -125,16 +175,60 @@ def inversion(csr, rt, ctoa, lutaot):
   return float('nan')
 
 
-def writetoh5(fn, aot, lon, lat):
+#Scene date from a PSAC name like HJ2A_PSAC_E116.9_N35.8_20201106_L10000015715
+def scenedate(fn):
+  m=re.search(r'_(\d{4})(\d{2})(\d{2})_', path.basename(fn))
+  return '-'.join(m.groups()) if m else None
+
+
+#scenetime is an ISO string, e.g. 2020-11-06T03:10:00, or a date only
+#matchup.py uses it to apply its time tolerance
+def writetoh5(fn, aot, lon, lat, scenetime=None):
   with openh5(fn, 'w') as fo:
+    if scenetime: fo.attrs['SceneTime']=scenetime
     fo.create_dataset('AOT550', data=aot, compression=9, dtype='f')
     fo.create_dataset('Latitude', data=lat, compression=9, dtype='f')
     fo.create_dataset('Longitude', data=lon, compression=9, dtype='f')
 
 
-def main(psacfn, lutfn, aotfn):
-  toa, sr, bl, ir, sza, vza, raa, lon, lat=readpsac(psacfn)
-  lutdata, lutsza, lutvza, lutraa, lutaot=readlut(lutfn)
+#Accumulated wall time per stage and pixel counts per failure reason
+#Timers cost a perf_counter call per stage, so they are off unless asked
+class RunStats(object):
+  reasons=['success', 'nan_geometry', 'nan_reflectance', 'no_bracket', 'nonpositive', 'above_cap']
+
+  def __init__(self, timing=False):
+    self.timing=timing
+    self.seconds={}
+    self.calls={}
+    self.counts=dict.fromkeys(self.reasons, 0)
+
+  #Call func, adding its run time to stage when timing
+  def timed(self, stage, func, *args):
+    if not self.timing: return func(*args)
+    t=time.perf_counter()
+    r=func(*args)
+    self.seconds[stage]=self.seconds.get(stage, 0.)+time.perf_counter()-t
+    self.calls[stage]=self.calls.get(stage, 0)+1
+    return r
+
+  def count(self, reason):
+    self.counts[reason]+=1
+
+  def writejson(self, fn, **extra):
+    report=dict(extra, counts=self.counts)
+    if self.timing:
+      report['stages']={k: {'seconds': self.seconds[k], 'calls': self.calls[k]} for k in self.seconds}
+      npixel=sum(self.counts.values())
+      total=sum(self.seconds.values())
+      report['pixels_per_second']=npixel/total if total else None
+    with open(fn, 'w') as fo:
+      json.dump(report, fo, indent=2)
+
+
+def main(psacfn, lutfn, aotfn, reportfn=None, timing=False, scenetime=None):
+  stats=RunStats(timing)
+  toa, sr, bl, ir, sza, vza, raa, lon, lat=stats.timed('readpsac', readpsac, psacfn)
+  lutdata, lutsza, lutvza, lutraa, lutaot=stats.timed('readlut', readlut, lutfn)
   
   outofrange=0
   well=0
@@ -143,18 +237,49 @@ def main(psacfn, lutfn, aotfn):
   lenaot=len(lutaot)
   for nl in range(sr.shape[0]):
     for ns in range(sr.shape[1]):
-      aotinv[nl, ns]=inversion(sr[nl, ns], calproper(sza[nl, ns], vza[nl, ns], raa[nl, ns],
-        lutsza, lutvza, lutraa, lutdata, lenaot), toa[nl, ns], lutaot)
-      if 0<aotinv[nl, ns]<6: well+=1
+      rt=stats.timed('calproper', calproper, sza[nl, ns], vza[nl, ns], raa[nl, ns],
+        lutsza, lutvza, lutraa, lutdata, lenaot)
+      aotinv[nl, ns]=stats.timed('inversion', inversion, sr[nl, ns], rt, toa[nl, ns], lutaot)
+      if 0<aotinv[nl, ns]<6: reason='success'
+      elif not np.isfinite(sza[nl, ns]+vza[nl, ns]+raa[nl, ns]): reason='nan_geometry'
+      elif not np.isfinite(sr[nl, ns]+toa[nl, ns]): reason='nan_reflectance'
+      elif np.isnan(aotinv[nl, ns]): reason='no_bracket'
+      elif aotinv[nl, ns]<=0: reason='nonpositive'
+      else: reason='above_cap'
+      stats.count(reason)
+      if reason=='success': well+=1
       else: outofrange+=1
   
-  writetoh5(aotfn, aotinv, lon, lat)
+  stats.timed('writetoh5', writetoh5, aotfn, aotinv, lon, lat, scenetime or scenedate(psacfn))
   print('n of outrange: ', outofrange)
   print('n of success : ', well)
+  if reportfn:
+    stats.writejson(reportfn, psac=psacfn, lut=lutfn, output=aotfn, shape=list(sr.shape))
+  return stats
 
 
 if __name__=='__main__':
   psacfn='HJ2A_PSAC_E116.9_N35.8_20201106_L10000015715.hdf5'
   lutfn='LUT_670'
   outfn='AOT550.hdf5'
-  main(psacfn, lutfn, outfn)
+  reportfn, profilefn, timing, scenetime=None, None, False, None
+  
+  #Update parameters from CLI
+  try:
+    opts, args=getopt(sys.argv[1:], 'tr:p:s:h', ['timers', 'report=', 'profile=', 'scenetime=', 'help'])
+    for opt, arg in opts:
+      if opt in ['-t', '--timers']: timing=True
+      elif opt in ['-r', '--report']: reportfn=arg
+      elif opt in ['-p', '--profile']: profilefn=arg
+      elif opt in ['-s', '--scenetime']: scenetime=arg
+      elif opt in ['-h', '--help']: usage()
+      else: assert False, "unhandled option"
+    if args: psacfn, lutfn, outfn=args
+  except (GetoptError, ValueError): usage()
+  reportfn=reportfn or path.splitext(outfn)[0]+'.json'
+  
+  if profilefn:
+    import cProfile
+    cProfile.run('main(psacfn, lutfn, outfn, reportfn, timing, scenetime)', profilefn)
+  else:
+    main(psacfn, lutfn, outfn, reportfn, timing, scenetime)
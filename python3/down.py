@@ -3,24 +3,223 @@
 
 url="https://public.spider.surfsara.nl/project/spexone/Public2/PACE/20210412"
 downdir="./downdir"
+nworkers=8 #threads shared by directory crawling and file downloads
+perhost=4 #max concurrent requests to a single host
+chunksize=1<<20 #bytes held in memory per streamed download
+manifestname=".manifest.json" #size and validators of every mirrored url
+timeout=(10, 60) #seconds to connect and between two reads, so a stalled host frees its slot
+saveinterval=5 #seconds between two manifest saves during a crawl
+trustlisting=False #skip files of an unchanged listing without asking, only safe if it shows sizes and dates
 
 
 import requests
 import re
 import os
+import json
+import hashlib
+import time
+import threading
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+#Pooled session, one connection pool per host
+def makesession(poolsize=nworkers):
+  session=requests.Session()
+  adapter=requests.adapters.HTTPAdapter(pool_connections=poolsize, pool_maxsize=poolsize)
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+
+class Mirror(object):
+  def __init__(self, session=None, nworkers=nworkers, perhost=perhost, chunksize=chunksize, timeout=timeout, trustlisting=trustlisting,
+      saveinterval=saveinterval):
+    self.session=session or makesession(nworkers)
+    self.nworkers=nworkers
+    self.perhost=perhost
+    self.chunksize=chunksize
+    self.timeout=timeout
+    self.trustlisting=trustlisting
+    self.hostlocks={}
+    self.lock=threading.Lock()
+    self.manifest={}
+    self.manifestfn=None
+    self.saveinterval=saveinterval
+    self.lastsave=0.
+    self.stopped=threading.Event() #set on Ctrl-C so running streams stop
+
+  #Bound the number of in-flight requests to every host
+  def hostlimit(self, absurl):
+    host=urlsplit(absurl).netloc
+    with self.lock:
+      if host not in self.hostlocks:
+        self.hostlocks[host]=threading.BoundedSemaphore(self.perhost)
+      return self.hostlocks[host]
+
+  #Manifest maps url -> {size, etag, modified} for files
+  #and url -> {etag, modified, digest, entries} for directory listings
+  def loadmanifest(self, fn):
+    if os.path.exists(fn):
+      with open(fn) as fo:
+        self.manifest=json.load(fo)
+
+  def savemanifest(self, fn):
+    with self.lock:
+      tmp=fn+".part"
+      with open(tmp, "w") as fo:
+        json.dump(self.manifest, fo, indent=1, sort_keys=True)
+      os.replace(tmp, fn)
+
+  #Save the manifest at most once per saveinterval, so a killed run
+  #loses only the last few records
+  def checkpoint(self):
+    if self.manifestfn is None: return
+    now=time.monotonic()
+    with self.lock:
+      if now-self.lastsave<self.saveinterval: return
+      self.lastsave=now
+    self.savemanifest(self.manifestfn)
+
+  def record(self, absurl, **entry):
+    with self.lock:
+      self.manifest[absurl]=entry
+    self.checkpoint()
+
+  #Conditional request headers built from the stored validators
+  def validators(self, entry):
+    headers={}
+    if entry.get("etag"): headers["If-None-Match"]=entry["etag"]
+    if entry.get("modified"): headers["If-Modified-Since"]=entry["modified"]
+    return headers
+
+  #Returns (subdirs, files) as lists of (absurl, localpath) and (absurl, localpath, unchanged)
+  #Files of an unchanged listing may be trusted without asking the server again
+  def listdir(self, url, currentlocaldir):
+    dirs, files=[], []
+    if not url.endswith("/"): url+="/"
+    entry=self.manifest.get(url, {})
+    with self.hostlimit(url):
+      r=self.session.get(url, headers=self.validators(entry) if "entries" in entry else {}, timeout=self.timeout)
+    if r.status_code==304:
+      unchanged=self.trustlisting
+      entries=entry["entries"]
+    else:
+      r.raise_for_status()
+      digest=hashlib.sha1(r.content).hexdigest()
+      unchanged=self.trustlisting and entry.get("digest")==digest
+      #Fancy indexes link every entry twice, through its icon and its name
+      entries=list(dict.fromkeys(suburl for suburl in re.findall(r"(?<=href=\").+?(?=\")|(?<=href=\').+?(?=\')", r.text)
+        if not suburl.startswith(("?", "/", "../", "http:", "https:")))) #sorting, parent or external link
+      self.record(url, etag=r.headers.get("ETag"), modified=r.headers.get("Last-Modified"), digest=digest, entries=entries)
+    for suburl in entries:
+      abssuburl=urljoin(url, suburl)
+      localpath=os.path.join(currentlocaldir, suburl)
+      if suburl.endswith("/"): dirs.append((abssuburl, localpath)) #directory
+      else: files.append((abssuburl, localpath, unchanged)) #file
+    return dirs, files
+
+  #A local file the manifest does not know, e.g. from a run killed before
+  #its last save, is kept if its size matches the remote Content-Length
+  #A failed HEAD, e.g. a server rejecting it, leaves the file to download
+  def adopt(self, abssuburl, localpath):
+    try:
+      with self.hostlimit(abssuburl):
+        r=self.session.head(abssuburl, allow_redirects=True, timeout=self.timeout)
+    except requests.RequestException: return False
+    if not r.ok or r.headers.get("Content-Length")!=str(os.path.getsize(localpath)): return False
+    self.record(abssuburl, etag=r.headers.get("ETag"), modified=r.headers.get("Last-Modified"),
+      size=os.path.getsize(localpath))
+    return True
+
+  #Stream into localpath.part, resume it with a Range request if present,
+  #and rename into place once complete
+  def download(self, abssuburl, localpath, unchanged=False):
+    if abssuburl not in self.manifest and os.path.exists(localpath) and self.adopt(abssuburl, localpath): return
+    entry=self.manifest.get(abssuburl, {})
+    exists=os.path.exists(localpath) and os.path.getsize(localpath)==entry.get("size")
+    if exists and unchanged: return
+    partpath=localpath+".part"
+    headers=self.validators(entry) if exists else {}
+    validator=entry.get("etag") or entry.get("modified")
+    offset=os.path.getsize(partpath) if validator and not exists and os.path.exists(partpath) else 0
+    if offset:
+      headers["Range"]="bytes=%d-" % offset
+      headers["If-Range"]=validator
+    etag, modified=entry.get("etag"), entry.get("modified")
+    with self.hostlimit(abssuburl):
+      with self.session.get(abssuburl, headers=headers, stream=True, timeout=self.timeout) as r:
+        if r.status_code==304: return
+        #416 with Content-Range: bytes */N, the partial file is complete if offset==N
+        status=r.status_code
+        total=r.headers.get("Content-Range", "").rpartition("/")[2]
+        if status!=416:
+          r.raise_for_status()
+          etag, modified=r.headers.get("ETag"), r.headers.get("Last-Modified")
+          #A partial file is only valid for the exact version it was started from
+          if offset and status!=206: offset=0
+          self.record(abssuburl, etag=etag, modified=modified, size=None)
+          print("Resuming at %d: " % offset if offset else "Downloading to: ", localpath)
+          with open(partpath, "ab" if offset else "wb") as fo:
+            for chunk in r.iter_content(self.chunksize):
+              if self.stopped.is_set(): return #keep the .part for a Range resume
+              fo.write(chunk)
+    if status==416 and total!=str(offset): #partial file longer than the remote one
+      os.remove(partpath)
+      return self.download(abssuburl, localpath)
+    os.replace(partpath, localpath)
+    self.record(abssuburl, etag=etag, modified=modified, size=os.path.getsize(localpath))
+
+  #Returns the (url, error) of every failed listing or download
+  #A failure is reported and the rest of the tree is still mirrored
+  def handledir(self, url, currentlocaldir, manifestfn=None):
+    os.makedirs(currentlocaldir, exist_ok=True)
+    manifestfn=manifestfn or os.path.join(currentlocaldir, manifestname)
+    self.loadmanifest(manifestfn)
+    self.manifestfn=manifestfn
+    failed=[]
+    self.stopped.clear()
+    pool=ThreadPoolExecutor(self.nworkers)
+    try:
+      jobs={pool.submit(self.listdir, url, currentlocaldir): url}
+      submitted={url.rstrip("/")+"/"} #a url linked from several listings is fetched once
+      pending=set(jobs)
+      while pending:
+        done, pending=wait(pending, return_when=FIRST_COMPLETED)
+        for job in done:
+          joburl=jobs.pop(job)
+          try: result=job.result()
+          except Exception as e:
+            print("Failed: ", joburl, e)
+            failed.append((joburl, e))
+            continue
+          if result is None: continue #finished download
+          dirs, files=result
+          for abssuburl, localpath in dirs:
+            if abssuburl in submitted: continue
+            submitted.add(abssuburl)
+            os.makedirs(localpath, exist_ok=True)
+            jobs[pool.submit(self.listdir, abssuburl, localpath)]=abssuburl
+          for abssuburl, localpath, unchanged in files:
+            if abssuburl in submitted: continue
+            submitted.add(abssuburl)
+            jobs[pool.submit(self.download, abssuburl, localpath, unchanged)]=abssuburl
+        pending=set(jobs) #all submitted jobs not yet collected
+    except BaseException:
+      self.stopped.set()
+      raise
+    finally:
+      #On Ctrl-C queued jobs are dropped and running ones stop at their next chunk
+      pool.shutdown(cancel_futures=True)
+      self.savemanifest(manifestfn)
+      self.manifestfn=None
+    if failed: print("n of failures: ", len(failed))
+    return failed
 
 
 def handledir(url, currentlocaldir):
-  for suburl in re.findall(r"(?<=href=\").+?(?=\")|(?<=href=\').+?(?=\')", requests.get(url).text)[1:]:
-    abssuburl=os.path.join(url, suburl)
-    localpath=os.path.join(currentlocaldir, suburl)
-    if suburl.endswith("/"): #directory
-      os.mkdir(localpath)
-      handledir(abssuburl, localpath)
-    else: #file
-      print("Downloading to: ", localpath)
-      with open(localpath, "wb") as fo:
-        fo.write(requests.get(abssuburl).content)
-
-
-handledir(url, downdir)
+  return Mirror().handledir(url, currentlocaldir)
+
+
+if __name__=='__main__':
+  if handledir(url, downdir): raise SystemExit(1)
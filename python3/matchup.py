@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+
+"""
+
+Description:
+  Python3 scripts to match AOT550 granules written by aodInversion.py
+  Against ground-station sites or any other point measurements
+  And report the pairs with ScatterPlot.py
+
+Arguments:
+  -s, --sites=FILE (REQUIRED)
+         CSV of reference points with header site,time,lat,lon,aot
+         time in ISO format, e.g. 2020-11-06T03:10:00
+  -o, --output=FILE (OPTIONAL)
+         Output CSV of the matched pairs
+         matchup.csv by default
+  -n, --window=N (OPTIONAL)
+         Size of the N x N pixel window around each site
+         3 by default
+  -d, --distance=FLOAT (OPTIONAL)
+         Max distance in km between a site and its nearest pixel
+         5 by default
+  -t, --time=FLOAT (OPTIONAL)
+         Max time difference in minutes between a site record and the granule
+         Scene time is the SceneTime attribute written by aodInversion.py
+         Or a time in the granule name, e.g. 20201106T031000
+         If only a date is known, records of the same day are used
+         30 by default
+  -c, --cache=DIR (OPTIONAL)
+         Directory to keep the pixel index of every granule for later runs
+         About 35 bytes per pixel, e.g. 300 MB for a 3000 x 3000 granule
+         Nothing is evicted, so only worth it when granules are matched again
+         No cache by default, -c '' also turns it off
+  -j, --jobs=N (OPTIONAL)
+         Number of processes
+         Number of CPUs by default
+  -p, --plot=FILE (OPTIONAL)
+         Save the density scatter of the pairs to FILE
+  -h, --help
+         Show the manuals to this script
+
+Example:
+  matchup.py -s aeronet.csv AOT550_20201106T031000.hdf5 AOT550_20201107T030500.hdf5
+    Means match the two granules against sites in aeronet.csv
+    with 3 x 3 windows, 5 km and 30 minutes tolerance
+  matchup.py -s aeronet.csv -n 5 -d 10 -p scatter.png *.hdf5
+    Means 5 x 5 windows within 10 km
+    and the density scatter is saved to scatter.png
+
+Window statistics:
+  Site records with non-finite or negative aot, e.g. -999 fill values, are dropped
+  Only sites with at least half of the window valid (0<AOT550<6) are kept
+  Output columns are
+  granule,site,lat,lon,distance,nsite,aot,nvalid,mean,median,std
+
+"""
+
+import os
+import re
+import sys
+import pickle
+import hashlib
+import numpy as np
+from getopt import getopt, GetoptError
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from h5py import File as openh5
+
+
+R=6371. #Earth radius in km
+
+
+#Display Usage in stdout
+def usage():
+  with open(sys.argv[0]) as fo:
+    for _ in range(3): next(fo)
+    for _ in iter(int, 1):
+      l=fo.readline()
+      if l.startswith('"""'): break
+      else: print(l.rstrip())
+  sys.exit(2)
+
+
+#Unit vectors so that wrap-around of longitude needs no special care
+def xyz(lat, lon):
+  lat, lon=np.radians(lat), np.radians(lon)
+  return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def readsites(fn):
+  sites={'site': [], 'time': [], 'lat': [], 'lon': [], 'aot': []}
+  with open(fn) as fo:
+    header=next(fo).strip().split(',')
+    for line in fo:
+      if not line.strip(): continue
+      for k, v in zip(header, line.strip().split(',')): sites[k].append(v)
+  sites['time']=np.array([datetime.fromisoformat(_) for _ in sites['time']])
+  for k in ['lat', 'lon', 'aot']: sites[k]=np.array(sites[k], dtype=np.float64)
+  sites['site']=np.array(sites['site'])
+  #Drop missing values and fill values such as -999
+  valid=np.isfinite(sites['aot'])&(sites['aot']>=0)
+  if not valid.all():
+    print('n of invalid site records: ', (~valid).sum())
+    for k in sites: sites[k]=sites[k][valid]
+  return sites
+
+
+#Time range of a granule from its SceneTime attribute (see aodInversion.py)
+#or else from a YYYYMMDDTHHMMSS or YYYYMMDD in its name
+#A date without time matches the whole day, None if there is no usable date
+def granuletime(fn, tol):
+  with openh5(fn) as fo: stamp=fo.attrs.get('SceneTime')
+  t, dateonly=None, False
+  if stamp is not None:
+    stamp=stamp.decode() if isinstance(stamp, bytes) else str(stamp)
+    try: t, dateonly=datetime.fromisoformat(stamp), len(stamp)<=10
+    except ValueError: print('Invalid SceneTime %s, trying the name: ' % stamp, fn)
+  if t is None:
+    for m in re.finditer(r'(\d{8})(?:[T_]?(\d{6}))?', os.path.basename(fn)):
+      try: t=datetime.strptime(m.group(1)+(m.group(2) or ''), '%Y%m%d%H%M%S' if m.group(2) else '%Y%m%d')
+      except ValueError: continue
+      dateonly=m.group(2) is None
+      break
+  if t is None:
+    print('Skipped, no scene time: ', fn)
+    return None
+  if dateonly:
+    print('No scene time, matching the whole day: ', fn)
+    return t, t+timedelta(days=1)
+  return t-tol, t+tol
+
+
+def readgranule(fn):
+  with openh5(fn) as fo:
+    return fo['AOT550'][:,:], fo['Latitude'][:,:], fo['Longitude'][:,:]
+
+
+#KD-tree over pixel centres, built once per granule
+#and optionally cached on disk keyed by path, size and mtime of the granule
+def pixelindex(fn, lat, lon, cachedir=None):
+  cachefn=None
+  if cachedir:
+    st=os.stat(fn)
+    key=hashlib.sha1(('%s|%d|%d' % (os.path.abspath(fn), st.st_size, st.st_mtime_ns)).encode()).hexdigest()
+    cachefn=os.path.join(cachedir, key+'.kdtree')
+    if os.path.exists(cachefn):
+      with open(cachefn, 'rb') as fo: return pickle.load(fo)
+  valid=np.isfinite(lat)&np.isfinite(lon)
+  #Unbalanced tree with large leaves builds about twice as fast, queries are few
+  tree=(cKDTree(xyz(lat[valid], lon[valid]), leafsize=64, balanced_tree=False), np.flatnonzero(valid))
+  if cachefn:
+    os.makedirs(cachedir, exist_ok=True)
+    with open(cachefn+'.part', 'wb') as fo: pickle.dump(tree, fo, pickle.HIGHEST_PROTOCOL)
+    os.replace(cachefn+'.part', cachefn)
+  return tree
+
+
+#Returns rows of granule,site,lat,lon,distance,nsite,aot,nvalid,mean,median,std
+def matchgranule(fn, sites, window=3, distance=5., tol=timedelta(minutes=30), cachedir=None):
+  trange=granuletime(fn, tol)
+  if trange is None: return []
+  intime=(sites['time']>=trange[0])&(sites['time']<=trange[1])
+  if not intime.any(): return []
+
+  #Average the records of every site within the time range
+  names, first, inverse=np.unique(sites['site'][intime], return_index=True, return_inverse=True)
+  lat, lon=sites['lat'][intime][first], sites['lon'][intime][first]
+  nsite=np.bincount(inverse)
+  siteaot=np.bincount(inverse, weights=sites['aot'][intime])/nsite
+
+  aot, plat, plon=readgranule(fn)
+  tree, pixels=pixelindex(fn, plat, plon, cachedir)
+  chord=2*np.sin(distance/(2*R))
+  d, i=tree.query(xyz(lat, lon), distance_upper_bound=chord)
+
+  rows=[]
+  half=window//2
+  for k in np.flatnonzero(np.isfinite(d)):
+    nl, ns=np.unravel_index(pixels[i[k]], aot.shape)
+    sub=aot[max(nl-half, 0):nl+half+1, max(ns-half, 0):ns+half+1]
+    sub=sub[(sub>0)&(sub<6)]
+    if sub.size<window*window/2: continue
+    rows.append((fn, names[k], lat[k], lon[k], 2*R*np.arcsin(d[k]/2), nsite[k], siteaot[k],
+      sub.size, sub.mean(), np.median(sub), sub.std()))
+  return rows
+
+
+def writecsv(fn, rows):
+  with open(fn, 'w') as fo:
+    fo.write('granule,site,lat,lon,distance,nsite,aot,nvalid,mean,median,std\n')
+    for row in rows:
+      fo.write('%s,%s,%.5f,%.5f,%.3f,%d,%.4f,%d,%.4f,%.4f,%.4f\n' % row)
+
+
+def main(granules, sitefn, outfn='matchup.csv', window=3, distance=5., tol=timedelta(minutes=30),
+    cachedir=None, jobs=None, plotfn=None):
+  sites=readsites(sitefn)
+  rows=[]
+  with ProcessPoolExecutor(jobs) as pool:
+    futures=[pool.submit(matchgranule, fn, sites, window, distance, tol, cachedir) for fn in granules]
+    for fn, future in zip(granules, futures):
+      try: rows+=future.result()
+      except Exception as e: print('Failed: ', fn, e)
+  writecsv(outfn, rows)
+  print('n of matchups: ', len(rows))
+
+  if rows:
+    from ScatterPlot import Density, densityplot
+    x=np.array([_[6] for _ in rows])
+    y=np.array([_[8] for _ in rows])
+    d=Density(lim=max(x.max(), y.max())*1.1, bins=100).add(x, y)
+    print('slope, intercept, R^2, RMSE, bias: ', ', '.join('%.4f' % _ for _ in d.stats()))
+    if plotfn: densityplot(d, plotfn)
+  return rows
+
+
+if __name__=='__main__':
+
+  #Default parameters
+  sitefn, outfn, plotfn, cachedir=None, 'matchup.csv', None, None
+  window, distance, tol, jobs=3, 5., timedelta(minutes=30), None
+
+  #Update parameters from CLI
+  try:
+    opts, granules=getopt(sys.argv[1:], 's:o:n:d:t:c:j:p:h',
+              ['sites=', 'output=', 'window=', 'distance=', 'time=', 'cache=', 'jobs=', 'plot=', 'help'])
+    for opt, arg in opts:
+      if opt in ['-s', '--sites']: sitefn=arg
+      elif opt in ['-o', '--output']: outfn=arg
+      elif opt in ['-n', '--window']: window=int(arg)
+      elif opt in ['-d', '--distance']: distance=float(arg)
+      elif opt in ['-t', '--time']: tol=timedelta(minutes=float(arg))
+      elif opt in ['-c', '--cache']: cachedir=arg
+      elif opt in ['-j', '--jobs']: jobs=int(arg)
+      elif opt in ['-p', '--plot']: plotfn=arg
+      elif opt in ['-h', '--help']: usage()
+      else: assert False, "unhandled option"
+  except GetoptError: usage()
+  if sitefn is None or not granules: usage()
+  
+  main(granules, sitefn, outfn, window, distance, tol, cachedir, jobs, plotfn)